@@ -32,6 +32,9 @@ LIMITATIONS:
   to send a SYNC message. Therefore, SYNC rate will not be accurate at rates
   faster than 100Hz. The user should experiment to specify a SYNC faster rate
   than actual to reach fast SYNC rates.
+  With SocketCAN on Linux the SYNC messages are sent by the kernel
+  (Broadcast Manager) and are not affected by Python latencies.
+  On Windows the SYNC sender thread is raised to time critical priority.
 - Alternatively (recommended), for accurate SYNC messages, use the PCAN-VIEW
   software running in background to generate SYNC messages by sending a
   a 0x80 CAN_ID message with no data (DLC=0)
@@ -41,9 +44,17 @@ from __future__ import print_function
 
 import time
 import sys
+import os
+import io
 import struct
+import socket
 import argparse
+import ctypes
+import contextlib
 import math
+import functools
+import queue
+import threading
 import datetime as dt
 import can
 import tqdm
@@ -140,19 +151,10 @@ def parse_cli(open_browser=True):
                     When selecting UDF, user must ensure UDF tap matches \
                     the UDF coefficients loaded using --udf switch.",
                     type=str,
-                    choices=['MV_AVG0', 'MV_AVG2', 'MV_AVG4', 'MV_AVG8',
-                             'MV_AVG16', 'MV_AVG32', 'MV_AVG64', 'MV_AVG128',
-                             'K32_FC50', 'K32_FC100', 'K32_FC200', 'K32_FC400',
-                             'K64_FC50', 'K64_FC100', 'K64_FC200', 'K64_FC400',
-                             'K128_FC50', 'K128_FC100', 'K128_FC200','K128_FC400',
-                             'K32_FC25', 'K32_FC50', 'K32_FC100', 'K32_FC200',
-                             'K64_FC25', 'K64_FC50', 'K64_FC100', 'K64_FC200',
-                             'K128_FC25', 'K128_FC50', 'K128_FC100',
-                             'K128_FC200','K64_FC83', 'K64_FC220', 'K128_FC36',
-                             'K128_FC110', 'K128_FC350', 'K512_FC9',
-                             'K512_FC16', 'K512_FC60', 'K512_FC210',
-                             'K512_FC460', 'UDF4', 'UDF64',
-                             'UDF128', 'UDF512'], default=None)
+                    # Names of all filter tables, duplicates removed
+                    choices=list(dict.fromkeys(
+                        [*FILTER_SEL, *FILTER_SEL2, *FILTER_SEL_ACC])),
+                    default=None)
     parser.add_argument("--tempc",
                     help="specifies to enable temperature data in sensor data",
                     action="store_true")
@@ -219,6 +221,13 @@ def parse_cli(open_browser=True):
     type=str,
     )
     parser.add_argument(
+    "-v",
+    "--verbose",
+    help="specifies to print each unrecognized CAN message, \
+            if not specified, only a count is printed",
+    action="store_true",
+    )
+    parser.add_argument(
     "--svcfg",
     help="save configuration",
     action="store_true",
@@ -244,6 +253,8 @@ def parse_cli(open_browser=True):
 #args = parse_cli()
 # CANopen era starts from Jan 1, 1984
 CANOPEN_ERA_ = dt.datetime(1984, 1, 1)
+# CANopen era as seconds since 1970-01-01, both naive
+CANOPEN_ERA_POSIX_INT = int((CANOPEN_ERA_ - dt.datetime(1970, 1, 1)).total_seconds())
 # user-defined imports
 #####################################
 
@@ -390,19 +401,13 @@ cob_id = {
     "HB2": 0x702,
     }
 
-hb_id = {
-    
-}
+# HB CAN_IDs of node 1 ~ node_num
+hb_ids = frozenset()
 
 def set_hb_id(node_num):
-    key = []
-    value = []
-    for i in range(node_num):
-        id=i+1
-        hbstr = "HB" + str(id)
-        key.append(hbstr)
-        value.append(0x700 + id)
-        hb_id.update(zip(key, value))
+    global hb_ids
+
+    hb_ids = frozenset(cob_id["HB"] + node for node in range(1, node_num + 1))
 
 # NMT command
 nmt = {
@@ -412,25 +417,34 @@ nmt = {
     "RES_NODE": 0x81,
     "RES_COMM": 0x82,
 }
+# NMT state reported in the HB message
+hb_state = {
+    "STOPPED": 0x04,
+    "OPERATIONAL": 0x05,
+    "PRE-OP": 0x7F,
+}
+
+# Mask to match all 11 bits of a standard CAN_ID
+CAN_SFF_MASK = 0x7FF
 
 tpdo1_filter = {
     "can_id": cob_id["TPDO1"],
-    "can_mask": cob_id["TPDO1"],
+    "can_mask": CAN_SFF_MASK,
     "extended": False,
 }
 tpdo2_filter = {
     "can_id": cob_id["TPDO2"],
-    "can_mask": cob_id["TPDO2"],
+    "can_mask": CAN_SFF_MASK,
     "extended": False,
 }
 tpdo3_filter = {
     "can_id": cob_id["TPDO3"],
-    "can_mask": cob_id["TPDO3"],
+    "can_mask": CAN_SFF_MASK,
     "extended": False,
 }
 tpdo4_filter = {
     "can_id": cob_id["TPDO4"],
-    "can_mask": cob_id["TPDO4"],
+    "can_mask": CAN_SFF_MASK,
     "extended": False,
 }
 op_filter = {
@@ -463,10 +477,45 @@ hb2_filter = {
     "can_mask": 0x700,
     "extended": False,
 }
+# TPDO1 0x180 & TPDO3 0x380 differ only in bit 9, one filter matches both
+# TPDO2 0x280 & TPDO4 0x480 differ in 2 bits, masking them would also
+# pass 0x080 (EMCY) & 0x680, so they keep exact filters
+TPDO13_MASK = CAN_SFF_MASK & ~(cob_id["TPDO1"] ^ cob_id["TPDO3"])
+tpdo13_filter = {
+    "can_id": cob_id["TPDO1"],
+    "can_mask": TPDO13_MASK,
+    "extended": False,
+}
+# Receive loop filters, TPDO1~4 & HB
+# Set once on the bus by main(), rebuilt by set_bus_filter()
+# TPDOs first, python-can matches software filters in list order
+bus_filters = (tpdo13_filter, tpdo2_filter, tpdo4_filter, op_filter)
 
 # Misc Constants
 #################
 GRAVITY = 9.80665
+# Number of rows the writer thread collects in memory per file write
+WRITE_BLOCK = 512
+# Maximum number of rows per console write
+CONSOLE_BLOCK = 128
+# CSV file write buffer size in bytes
+CSV_BUFSIZE = 1 << 20
+# Seconds to wait for an SDO response
+SDO_TIMEOUT = 1.0
+# Seconds for the node to apply new parameters after apply_param()
+APPLY_PARAM_DELAY = 3.0
+# SocketCAN receive buffer size in bytes
+SOCKETCAN_RCVBUF = 2 << 20
+# Windows thread access right & priority for the SYNC sender thread
+THREAD_SET_INFORMATION = 0x0020
+THREAD_PRIORITY_TIME_CRITICAL = 15
+# Seconds the receive loop blocks in bus.recv() waiting for a frame
+RECV_TIMEOUT = 1.0
+# HB messages are printed on the 1st and then every Nth per node
+HB_PRINT_INTERVAL = 100
+# Max. IMU samples reassembled at once by tpdo_slot_recv(), the oldest
+# incomplete sample is dropped when a new one does not fit
+TPDO_SLOTS = 8
 
 # Scale factor for gyro and accel
 #GYRO_SF = MODEL["GYRO_SCL"] * math.pi / 180
@@ -476,94 +525,48 @@ ACCL_SF = MODEL["ACCEL_SCL"]
 TEMPC_SF = MODEL["TEMPC_SCL"]
 TEMPC_25C = 0
 
+# Scale factors per IMU model
+# (SF_GYRO dps/bit, SF_ACCL mg/bit, SF_TEMP degC/bit,
+#  TEMPC_25C offset in 16bit mode @ 25C)
+MODEL_SF = {
+    'G320': (0.008, 0.2, -0.0037918, -2634),
+    'G354': (0.016, 0.20, -0.0037918, -2634),
+    'G570': (0.0151515, 0.4, -0.0037918, -2634),
+    'MIU': (0.0151515, 0.4, -0.0037918, -2634),
+    'G364PDC0': (0.0075, 0.125, -0.0037918, -2634),
+    'G364PDCA': (0.00375, 0.125, -0.0037918, -2634),
+}
+# Other models are matched on the first 7 characters
+MODEL_SF_PREFIX = {
+    # G365/G370PDC0
+    'G365PDC': (0.0151515, 0.16, -0.0037918, -2634),
+    'G370PDC': (0.0151515, 0.16, -0.0037918, -2634),
+    # G365/G370PDF0
+    'G365PDF': (0.0151515, 0.4, -0.0037918, -2634),
+    'G370PDF': (0.0151515, 0.4, -0.0037918, -2634),
+    'G552PR7': (0.0151515, 0.4, -0.0037918, -2634),
+    'G552PR1': (0.0151515, 0.4, -0.0037918, -2634),
+    'G570PR1': (0.0151515, 0.4, -0.0037918, -2634),
+    'G552PC1': (0.0151515, 0.4, -0.0037918, -2634),
+    'G552PC7': (0.0151515, 0.4, -0.0037918, -2634),
+    'G570PR2': (0.0151515, 0.5, 0.0039063, 0),
+    'G370PDG': (0.0151515, 0.5, 0.0039063, 0),
+    'G550PC2': (0.008, 0.2, -0.0037918, -2634),
+    'G55T2A0': (0.008, 0.2, -0.0037918, -2634),
+    'G55P200': (0.008, 0.2, -0.0037918, -2634),
+}
+# Unknown models are output unscaled
+MODEL_SF_DEFAULT = (1, 1, 1, 0)
+
 def setModel(imuModel):
     """Sets the global variable of the IMU Model
     """
+    SF_GYRO, SF_ACCL, SF_TEMP, TEMPC_25C = (
+        MODEL_SF.get(imuModel)
+        or MODEL_SF_PREFIX.get(imuModel[:7], MODEL_SF_DEFAULT)
+    )
     sf={}
-    length=0
-    model_epson = imuModel
-    length=len(imuModel)
-    #print(length)
-    if length <= 4:
-        if imuModel == 'G320':
-            # G320 specific constants
-            SF_GYRO = 0.008  # dps/bit
-            SF_ACCL = 0.2  # mg/bit
-            SF_TEMP = -0.0037918  # degC/bit
-            TEMPC_25C = -2634  # offset in 16bit mode @ 25C
-        elif imuModel == 'G354':
-            # G354 specific constants
-            SF_GYRO = 0.016  # dps/bit
-            SF_ACCL = 0.20  # mg/bit
-            SF_TEMP = -0.0037918  # degC/bit
-            TEMPC_25C = -2634  # offset in 16bit mode @ 25C
-        elif imuModel == 'G570':
-            # G365/G370PDF0 specific constants
-            SF_GYRO = 0.0151515  # dps/bit
-            SF_ACCL = 0.4  # mg/bit
-            SF_TEMP = -0.0037918  # degC/bit
-            TEMPC_25C = -2634  # offset in 16bit mode @ 25C
-        elif imuModel == 'MIU':
-            # G365/G370PDF0 specific constants
-            SF_GYRO = 0.0151515  # dps/bit
-            SF_ACCL = 0.4  # mg/bit
-            SF_TEMP = -0.0037918  # degC/bit
-            TEMPC_25C = -2634  # offset in 16bit mode @ 25C
-    elif length >= 8:
-        if imuModel == 'G364PDC0':
-            # G364PDC0 specific constants
-            SF_GYRO = 0.0075  # dps/bit
-            SF_ACCL = 0.125  # mg/bit
-            SF_TEMP = -0.0037918  # degC/bit
-            TEMPC_25C = -2634  # offset in 16bit mode @ 25C
-        elif imuModel == 'G364PDCA':
-            # G364PDCA specific constants
-            SF_GYRO = 0.00375  # dps/bit
-            SF_ACCL = 0.125  # mg/bit
-            SF_TEMP = -0.0037918  # degC/bit
-            TEMPC_25C = -2634  # offset in 16bit mode @ 25C
-        elif imuModel[:7] in ('G365PDC', 'G370PDC'):
-            # G365/G370PDC0 specific constants
-            SF_GYRO = 0.0151515  # dps/bit
-            SF_ACCL = 0.16  # mg/bit
-            SF_TEMP = -0.0037918  # degC/bit
-            TEMPC_25C = -2634  # offset in 16bit mode @ 25C
-        elif imuModel[:7] in ('G365PDF', 'G370PDF','G552PR7', 'G552PR1','G570PR1','G552PC1','G552PC7'):
-            # G365/G370PDF0 specific constants
-            SF_GYRO = 0.0151515  # dps/bit
-            SF_ACCL = 0.4  # mg/bit
-            SF_TEMP = -0.0037918  # degC/bit
-            TEMPC_25C = -2634  # offset in 16bit mode @ 25C
-        elif imuModel[:7] in ('G570PR2', 'G370PDG'):
-            SF_GYRO = 0.0151515  # dps/bit
-            SF_ACCL = 0.5  # mg/bit
-            SF_TEMP = 0.0039063  # degC/bit
-            TEMPC_25C = 0  # offset in 16bit mode @ 25C
-        elif imuModel[:7] in ('G550PC2','G55T2A0','G55P200'):
-            # G320 specific constants
-            SF_GYRO = 0.008  # dps/bit
-            SF_ACCL = 0.2  # mg/bit
-            SF_TEMP = -0.0037918  # degC/bit
-            TEMPC_25C = -2634  # offset in 16bit mode @ 25C
-    elif length == 7:
-        if imuModel in ('G552PR7', 'G552PR1','G570PR1','G365PDF','G370PDF'):
-            SF_GYRO = 0.0151515  # dps/bit
-            SF_ACCL = 0.4  # mg/bit
-            SF_TEMP = -0.0037918  # degC/bit
-            TEMPC_25C = -2634  # offset in 16bit mode @ 25C
-        elif imuModel in ('G570PR2', 'G370PDG'):
-            SF_GYRO = 0.0151515  # dps/bit
-            SF_ACCL = 0.5  # mg/bit
-            SF_TEMP = 0.0039063  # degC/bit
-            TEMPC_25C = 0  # offset in 16bit mode @ 25C
-
-    else:
-        # Other specific constants
-        SF_GYRO = 1  # dps/bit
-        SF_ACCL = 1  # mg/bit
-        SF_TEMP = 1  # degC/bit
-        TEMPC_25C = 0  # offset in 16bit mode @ 25C
-    sf['model_epson']=model_epson
+    sf['model_epson']=imuModel
     sf['SF_GYRO']=SF_GYRO
     sf['SF_ACCL']=SF_ACCL
     sf['SF_TEMP']=SF_TEMP
@@ -582,6 +585,12 @@ def set_cobid(node_id):
     cob_id["TSDO"] += node_id
     cob_id["HBx"] += node_id
 
+def sff_filter(can_id):
+    """
+    Returns a python-can filter matching exactly one standard CAN_ID
+    """
+    return {"can_id": can_id, "can_mask": CAN_SFF_MASK, "extended": False}
+
 def set_bus_filter(node_id):
     global cob_id
     global op_filter
@@ -589,18 +598,21 @@ def set_bus_filter(node_id):
     global tpdo2_filter
     global tpdo3_filter
     global tpdo4_filter
-
-    tpdo1_filter["can_id"] = cob_id["TPDO1"]
-    tpdo1_filter["can_mask"] = cob_id["TPDO1"]
-
-    tpdo2_filter["can_id"] = cob_id["TPDO2"]
-    tpdo2_filter["can_mask"] = cob_id["TPDO2"]
-
-    tpdo3_filter["can_id"] = cob_id["TPDO3"]
-    tpdo3_filter["can_mask"] = cob_id["TPDO3"]
-
-    tpdo4_filter["can_id"] = cob_id["TPDO4"]
-    tpdo4_filter["can_mask"] = cob_id["TPDO4"]
+    global tpdo13_filter
+    global rsdo_filter
+
+    global bus_filters
+
+    # Match exact CAN_IDs so the driver drops other nodes' PDOs
+    # Filters are rebuilt rather than mutated, so a filter list already
+    # handed to the bus never changes behind its back
+    tpdo1_filter = sff_filter(cob_id["TPDO1"])
+    tpdo2_filter = sff_filter(cob_id["TPDO2"])
+    tpdo3_filter = sff_filter(cob_id["TPDO3"])
+    tpdo4_filter = sff_filter(cob_id["TPDO4"])
+    rsdo_filter = sff_filter(cob_id["RSDO"])
+    tpdo13_filter = dict(tpdo1_filter, can_mask=TPDO13_MASK)
+    bus_filters = (tpdo13_filter, tpdo2_filter, tpdo4_filter, op_filter)
 
 def set_SCL(model):
     global GYRO_SF
@@ -625,38 +637,139 @@ def set_SCL(model):
 
 
 
-# Struct format for TPDO
+# Struct for TPDO
+# Precompiled, so the format string is not parsed on every call
 # < = Little endian, B = unsigned char
 # i = int (4 byte), I = unsigned int (4 byte)
 # h = short (2byte), H = unsigned short (2 byte)
-STRUCT_TPDO1 = "<ii"
-STRUCT_TPDO2 = "<iH"
-STRUCT_TPDO3 = "<HI"
-STRUCT_TPDO4="<i"
-STRUCT_HB="<B"
-# Struct format for SDO
-STRUCT_SDO4I = "<BHBI"
-STRUCT_SDO4i = "<BHBi"
-STRUCT_SDO2H = "<BHBHBB"
-STRUCT_SDO2h = "<BHBhBB"
-STRUCT_SDO1B = "<BHBBBBB"
+STRUCT_TPDO1 = struct.Struct("<ii")
+STRUCT_TPDO2 = struct.Struct("<iH")
+STRUCT_TPDO3 = struct.Struct("<HI")
+STRUCT_TPDO4 = struct.Struct("<i")
+STRUCT_HB = struct.Struct("<B")
+# Struct for SDO
+STRUCT_SDO4I = struct.Struct("<BHBI")
+STRUCT_SDO4i = struct.Struct("<BHBi")
+STRUCT_SDO2H = struct.Struct("<BHBHBB")
+STRUCT_SDO2h = struct.Struct("<BHBhBB")
+STRUCT_SDO1B = struct.Struct("<BHBBBBB")
+# Struct for ID strings read by SDO, characters in little endian order
+STRUCT_ID2W = struct.Struct("<II")
+STRUCT_ID1W = struct.Struct("<I")
+STRUCT_ID4H = struct.Struct("<HHHH")
+# Bound unpack for decode_block()
+# NOTE: One Struct.unpack call per TPDO is several times faster than
+#       slicing msg.data into per-field int.from_bytes calls
+# NOTE: Struct.unpack on msg.data (bytearray) is faster than
+#       unpack_from, and than unpack_from on a memoryview of it
+UNPACK_TPDO1 = STRUCT_TPDO1.unpack
+UNPACK_TPDO2 = STRUCT_TPDO2.unpack
+UNPACK_TPDO3 = STRUCT_TPDO3.unpack
+UNPACK_TPDO4 = STRUCT_TPDO4.unpack
+UNPACK_HB = STRUCT_HB.unpack
+# Struct for TIME, days (2 byte) + ms * 16 (4 byte)
+STRUCT_TIME = struct.Struct("<HI")
+PACK_TIME_INTO = STRUCT_TIME.pack_into
+# TIME message reused by time_send(), only its payload is rewritten
+time_msg = can.Message(
+    arbitration_id=cob_id["TIME"], data=bytearray(6), is_extended_id=False
+)
+# TSDO request message reused by the SDO functions, the payload is
+# rewritten in place and the CAN_ID set for the current node per send
+tsdo_msg = can.Message(
+    arbitration_id=cob_id["TSDO"], data=bytearray(8), is_extended_id=False
+)
 
 def get_pdo_struct_fmt(model):
     global STRUCT_TPDO1
     global STRUCT_TPDO2
     global STRUCT_TPDO3
     global STRUCT_TPDO4
+    global UNPACK_TPDO1
+    global UNPACK_TPDO2
+    global UNPACK_TPDO3
+    global UNPACK_TPDO4
 
     if model[:1] in ('A'):
-        STRUCT_TPDO1 = "<ii"
-        STRUCT_TPDO2 = "<iH"
-        STRUCT_TPDO3 = "<HI"
-        STRUCT_TPDO4 ="<i"
+        STRUCT_TPDO1 = struct.Struct("<ii")
+        STRUCT_TPDO2 = struct.Struct("<iH")
+        STRUCT_TPDO3 = struct.Struct("<HI")
+        STRUCT_TPDO4 = struct.Struct("<i")
     else:
-        STRUCT_TPDO1 = "<Hhhh"
-        STRUCT_TPDO2 = "<Hhhh"
-        STRUCT_TPDO3 = "<Hhhh"
-        STRUCT_TPDO4 = "<HIH"
+        STRUCT_TPDO1 = struct.Struct("<Hhhh")
+        STRUCT_TPDO2 = struct.Struct("<Hhhh")
+        STRUCT_TPDO3 = struct.Struct("<Hhhh")
+        STRUCT_TPDO4 = struct.Struct("<HIH")
+    UNPACK_TPDO1 = STRUCT_TPDO1.unpack
+    UNPACK_TPDO2 = STRUCT_TPDO2.unpack
+    UNPACK_TPDO3 = STRUCT_TPDO3.unpack
+    UNPACK_TPDO4 = STRUCT_TPDO4.unpack
+
+# TPDO handlers for the receive loop
+# Each handler keeps the raw payload in the sample state dict and
+# returns the bit to set in tpdo_captured
+# NOTE: Payloads are unpacked & scaled a block at a time by the row
+#       writer thread, see decode_block()
+def tpdo1_recv(msg, st):
+    # NOTE: python-can can.Message.timestamp is POSIX UTC Time!
+    st["can_timestamp"] = msg.timestamp
+    st["tpdo1"] = msg.data
+    return 1
+
+def tpdo2_recv(msg, st):
+    st["tpdo2"] = msg.data
+    return 2
+
+def tpdo3_recv(msg, st):
+    st["tpdo3"] = msg.data
+    return 4
+
+def tpdo4_recv(msg, st):
+    st["tpdo4"] = msg.data
+    return 8
+
+# IMU TPDO handler, pos is the TPDO number - 1
+# IMU TPDO1~4 all start with the 16-bit sample counter, so the payloads
+# are collected in a slot per counter value and TPDOs of consecutive
+# samples arriving out of order are not mixed into one row
+# When all enabled TPDOs of a sample are in, the slot is copied to the
+# state dict and tpdo_flg is returned, otherwise 0
+# NOTE: The Q-Acc only has the counter in TPDO2 and uses tpdo1~4_recv()
+def tpdo_slot_recv(msg, st, pos):
+    d = msg.data
+    count = d[0] | (d[1] << 8)
+    slots = st["slots"]
+    slot = slots.get(count)
+    if slot is None:
+        if len(slots) == TPDO_SLOTS:
+            # Slots are in arrival order, drop the oldest sample
+            del slots[next(iter(slots))]
+            st["slots_dropped"] += 1
+        # Disabled TPDOs keep the zero filled payload
+        slot = slots[count] = [0, 0, st["tpdo1"], st["tpdo2"], st["tpdo3"],
+                               st["tpdo4"]]
+    if pos == 0:
+        slot[1] = msg.timestamp
+    slot[2 + pos] = d
+    slot[0] |= 1 << pos
+    if slot[0] != st["tpdo_flg"]:
+        return 0
+    del slots[count]
+    (_, st["can_timestamp"], st["tpdo1"], st["tpdo2"], st["tpdo3"],
+     st["tpdo4"]) = slot
+    return slot[0]
+
+def hb_recv(msg, st, unpack_hb=UNPACK_HB, hb_base=cob_id["HB"]):
+    # HB base CAN_ID does not depend on the node, bound at definition
+    node = msg.arbitration_id - hb_base
+    hb_num = st["hb_num"]
+    hb_num[node] += 1
+    # Rate limited, a console write per HB stalls the receive loop
+    if hb_num[node] % HB_PRINT_INTERVAL == 1:
+        hb_msg = unpack_hb(msg.data)
+        print("HB detected CAN_ID: {}".format(hb_msg),", HB{} cyc=: {} times".format(node, hb_num[node]))
+    st["hb_captured"] |= 1
+    return 0
 
 # CAN driver setting
 def can_ports(args):
@@ -688,7 +801,9 @@ def print_header(file,args,model,ver,SNum):
 
     """
     Outputs header information before sensor row data
+    for IMU or Q-Acc (model A...) sensors
     """
+    is_acc = model[:1] in ('A')
 
     # Create Header Row
     if args.time_per_nsamples:
@@ -715,20 +830,27 @@ def print_header(file,args,model,ver,SNum):
         print("Unscaled Data", file=file)
     else:
         print("Scaled Data", file=file)
-        print("SF_GYRO={:+01.8f} (deg/sec)/lsb".format(GYRO_SF),
-              "SF_ACCL={:+01.8f} (mG)/lsb".format(ACCL_SF),
-              file=file
-              )
+        if is_acc:
+            print("SF_ACCL={:+01.8f} mG/lsb".format(ACCL_SF),
+                  file=file
+                  )
+        else:
+            print("SF_GYRO={:+01.8f} (deg/sec)/lsb".format(GYRO_SF),
+                  "SF_ACCL={:+01.8f} (mG)/lsb".format(ACCL_SF),
+                  file=file
+                  )
     # Customize the ROW heading based on types of data included in burst
     print("Sample No.", end="", file=file)
 
     if args.noscale:
-        print(",Gx[dec],Gy[dec],Gz[dec]", end="", file=file)
+        if not is_acc:
+            print(",Gx[dec],Gy[dec],Gz[dec]", end="", file=file)
         print(",Ax[dec],Ay[dec],Az[dec]", end="", file=file)
     else:
         #print(", Gx[rad/s], Gy[rad/s], Gz[rad/s]", end="", file=file)
         #print(", Ax[m/s^2], Ay[m/s^2], Az[m/s^2]", end="", file=file)
-        print(",Gx[deg/s],Gy[deg/s],Gz[deg/s]", end="", file=file)
+        if not is_acc:
+            print(",Gx[deg/s],Gy[deg/s],Gz[deg/s]", end="", file=file)
         print(",Ax[mG],Ay[mG],Az[mG]", end="", file=file)
     print(",CAN_Recv_Time", end="", file=file)
     print(",Time_Message", end="", file=file)
@@ -739,144 +861,239 @@ def print_header(file,args,model,ver,SNum):
     print(file=file)
 
 
-def print_row(
-        index_,
-        gx_, gy_, gz_,
-        ax_, ay_, az_,
-        sample_count_,
-        time_can_,
-        time_days_,
-        time_millisecs_,
-        tempc_,
-        file,
-        args
-):
+@functools.lru_cache(maxsize=8)
+def format_utc_secs(secs_):
     """
-    Outputs sensor row
+    Formats whole UTC seconds as 'YYYY-MM-DD hh:mm:ss', cached since
+    consecutive samples mostly fall in the same second
     """
-    print("{:08}".format(index_), end="", file=file)
-    if args.noscale:
-        print(", {:+06}, {:+06}, {:+06}".format(gx_, gy_, gz_),
-              end="", file=file)
-        print(", {:+06}, {:+06}, {:+06}".format(ax_, ay_, az_),
-              end="", file=file)
-    else:
-        print(", {:+05.06f}, {:+05.06f}, {:+05.06f}".format(gx_, gy_, gz_),
-              end="", file=file)
-        print(", {:+05.02f}, {:+05.02f}, {:+05.02f}".format(ax_, ay_, az_),
-              end="", file=file)
-
-    # CAN_recv timestamp is UTC
-    can_ = dt.datetime.utcfromtimestamp(time_can_)
-    # Calculate Timestamp from TIME message
-    day_ = dt.timedelta(days=time_days_)
-    ms_ = dt.timedelta(microseconds=time_millisecs_ * 1000)
-    time_stamp_ = CANOPEN_ERA_ + day_ + ms_
-    if args.tm_posix:
-        # NOTE: Convert to POSIX time (UTC)
-        print(", {:.06f}".format(can_.timestamp()), end="", file=file)
-        print(", {:.03f}".format(time_stamp_.timestamp()), end="", file=file)
-    else:
-        print(",", can_, end="", file=file)
-        print(",", time_stamp_, end="", file=file)
-    if args.tempc:
-        print(", {:+05.06f}".format(tempc_),end="", file=file)
-    if not args.no_count:
-        print(", {:05}".format(sample_count_), end="", file=file)
-    print(file=file)
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(secs_))
 
-# Sub function for CSV output
-def print_header_acc(file,args,model,ver,SNum):
 
+@functools.lru_cache(maxsize=8)
+def local_wall_to_posix(secs_):
     """
-    Outputs header information before sensor row data
+    Converts whole seconds of local wall time since 1970-01-01 to POSIX
+    seconds through the host timezone, cached since consecutive samples
+    mostly fall in the same second
     """
+    return (dt.datetime(1970, 1, 1) + dt.timedelta(seconds=secs_)).timestamp()
 
-    # Create Header Row
-    if args.time_per_nsamples:
-        print(
-            "Sending Time message every {} samples".format(args.time_per_nsamples),
-            file=file,
-        )
-    print(file=file)
-    print(str(args).replace("Namespace", "Parameters"), file=file)
-    print(file=file)
-    print(
-        "Log created by Python", "Press CTRL-C to exit early", file=file,
-    )
-    print(
-        "Creation Date:",
-        str(dt.datetime.now()),
-        ",PROD_ID=" + model,
-        ",VERSION=" + ver,
-        ",SERIAL_NUM=" + SNum,
-        file=file,
-    )
-    # Identify if outputting scaled or Raw digital data
-    if args.noscale:
-        print("Unscaled Data", file=file)
-    else:
-        print("Scaled Data", file=file)
-        print("SF_ACCL={:+01.8f} mG/lsb".format(ACCL_SF),
-              file=file
-              )
-    # Customize the ROW heading based on types of data included in burst
-    print("Sample No.", end="", file=file)
 
-    if args.noscale:
-        print(",Ax[dec],Ay[dec],Az[dec]", end="", file=file)
+def format_times(time_can_, time_days_, time_millisecs_, tm_posix):
+    """
+    Returns the CAN_Recv_Time and Time_Message columns
+    """
+    # CAN_recv timestamp is POSIX UTC, TIME message is days & ms
+    # since the CANopen era in host local time, see time_send()
+    if tm_posix:
+        ms_secs, ms_frac = divmod(time_millisecs_, 1000)
+        time_stamp_ = (local_wall_to_posix(CANOPEN_ERA_POSIX_INT
+                                           + time_days_ * 86400
+                                           + int(ms_secs))
+                       + ms_frac * 1e-3)
+        return f", {time_can_:.06f}, {time_stamp_:.03f}"
+    # Round to microseconds the same way as datetime.utcfromtimestamp
+    can_frac, can_secs = math.modf(time_can_)
+    can_secs, can_usecs = divmod(int(can_secs) * 1000000
+                                 + round(can_frac * 1000000), 1000000)
+    ms_secs, ms_usecs = divmod(round(time_millisecs_ * 1000), 1000000)
+    ms_secs += CANOPEN_ERA_POSIX_INT + time_days_ * 86400
+    # Both columns as 'YYYY-MM-DD hh:mm:ss.ssssss', CAN_recv in UTC
+    # and TIME message in local time
+    return (f", {format_utc_secs(can_secs)}.{can_usecs:06}"
+            f", {format_utc_secs(ms_secs)}.{ms_usecs:06}")
+
+
+@functools.lru_cache(maxsize=None)
+def compile_emit_block(is_acc, noscale, tm_posix, tempc, no_count,
+                       newline="\n"):
+    """
+    Generates a block formatter with the output flags baked in, so
+    formatting does not re-test the flags
+    The returned emit_block() takes a list of scaled rows and returns
+    their CSV lines, each ending with newline
+    """
+    # All rows of a block are formatted by one % operation on the row
+    # format repeated per row, the field formatting runs in C
+    if is_acc:
+        axes = ("ax_", "ay_", "az_")
+        fmts = ("%+06d",) * 3 if noscale else ("%+05.6f",) * 3
     else:
-        print(",Ax[mG],Ay[mG],Az[mG]", end="", file=file)
-    print(",CAN_Recv_Time", end="", file=file)
-    print(",Time_Message", end="", file=file)
-    if args.tempc:
-        print(",Tempc", end="", file=file)
-    if not args.no_count:
-        print(",Counter[dec]", end="", file=file)
-    print(file=file)
+        axes = ("gx_", "gy_", "gz_", "ax_", "ay_", "az_")
+        fmts = (("%+06d",) * 6 if noscale
+                else ("%+05.6f",) * 3 + ("%+05.2f",) * 3)
+    row_fmt = "%08d" + "".join(", " + fmt for fmt in fmts) + "%s"
+    values = ["index_", *axes,
+              "format_times(time_can_, time_days_, time_millisecs_, %s)"
+              % tm_posix]
+    if tempc:
+        row_fmt += ", %+05.6f"
+        values.append("tempc_")
+    if not no_count:
+        row_fmt += ", %05d"
+        values.append("sample_count_")
+    row_fmt += newline
+    src = (
+        "def emit_block(rows):\n"
+        "    values = []\n"
+        "    extend = values.extend\n"
+        "    for (index_, %s, sample_count_, time_can_, time_days_,\n"
+        "         time_millisecs_, tempc_) in rows:\n"
+        "        extend((%s,))\n"
+        "    return (ROW_FMT * len(rows)) %% tuple(values)\n"
+        % (", ".join(axes), ", ".join(values))
+    )
+    namespace = {"format_times": format_times, "ROW_FMT": row_fmt}
+    exec(src, namespace)
+    return namespace["emit_block"]
 
 
-def print_row_acc(
-        index_,
-        ax_, ay_, az_,
-        sample_count_,
-        time_can_,
-        time_days_,
-        time_millisecs_,
-        tempc_,
-        file,
-        args
-):
+def decode_block(rows, is_acc):
     """
-    Outputs sensor row
+    Unpacks and scales a block of raw TPDO payloads captured by the
+    receive loop
     """
-    print("{:08}".format(index_), end="", file=file)
-    if args.noscale:
-        print(", {:+06}, {:+06}, {:+06}".format(ax_, ay_, az_),
-              end="", file=file)
-    else:
-        print(", {:+05.06f}, {:+05.06f}, {:+05.06f}".format(ax_, ay_, az_),
-              end="", file=file)
-
-    # CAN_recv timestamp is UTC
-    can_ = dt.datetime.utcfromtimestamp(time_can_)
-    # Calculate Timestamp from TIME message
-    day_ = dt.timedelta(days=time_days_)
-    ms_ = dt.timedelta(microseconds=time_millisecs_ * 1000)
-    time_stamp_ = CANOPEN_ERA_ + day_ + ms_
-
-    if args.tm_posix:
-        # NOTE: Convert to POSIX time (UTC)
-        print(", {:.06f}".format(can_.timestamp()), end="", file=file)
-        print(", {:.03f}".format(time_stamp_.timestamp()), end="", file=file)
+    # Unpackers & scale factors are bound once per block
+    unpack1 = UNPACK_TPDO1
+    unpack2 = UNPACK_TPDO2
+    unpack3 = UNPACK_TPDO3
+    unpack4 = UNPACK_TPDO4
+    gyro_sf = GYRO_SF
+    accl_sf = ACCL_SF
+    tempc_sf = TEMPC_SF
+    tempc_25c = TEMPC_25C
+    out = []
+    append = out.append
+    if is_acc:
+        for index_, time_can_, tpdo1, tpdo2, tpdo3, tpdo4 in rows:
+            ax_, ay_ = unpack1(tpdo1)
+            az_, sample_count_ = unpack2(tpdo2)
+            time_days_, time_millisecs_ = unpack3(tpdo3)
+            tempc_, = unpack4(tpdo4)
+            append((index_, ax_ * accl_sf, ay_ * accl_sf, az_ * accl_sf,
+                    sample_count_, time_can_, time_days_,
+                    time_millisecs_ / 16, (tempc_ * tempc_sf) + tempc_25c))
+        return out
+    for index_, time_can_, tpdo1, tpdo2, tpdo3, tpdo4 in rows:
+        sample_count_, gx_, gy_, gz_ = unpack1(tpdo1)
+        _, ax_, ay_, az_ = unpack2(tpdo2)
+        _, angx_, _, _ = unpack3(tpdo3)
+        _, time_millisecs_, time_days_ = unpack4(tpdo4)
+        append((index_, gx_ * gyro_sf, gy_ * gyro_sf, gz_ * gyro_sf,
+                ax_ * accl_sf, ay_ * accl_sf, az_ * accl_sf,
+                sample_count_, time_can_, time_days_, time_millisecs_ / 16,
+                (angx_ + tempc_25c) * tempc_sf + 25))
+    return out
+
+
+def write_bytes(file, text):
+    """
+    Writes text to a file opened in binary mode
+    """
+    file.write(text.encode())
+
+
+def print_rows(write, rows, is_acc, emit_block):
+    """
+    Decodes and outputs raw sensor rows captured by the receive loop
+    with the block formatter from compile_emit_block()
+    """
+    write(emit_block(decode_block(rows, is_acc)))
+
+
+def row_writer(row_q, write, pbar, block, is_acc, emit_block,
+               flush_idle=False):
+    """
+    Writer thread, drains raw rows from row_q and outputs them in blocks
+    of up to block rows until the None sentinel is received
+    Each block is formatted in memory and handed to the file in one write
+    With flush_idle, a partial block is also output once row_q is empty
+    The progress bar, if any, is updated once per block
+    """
+    # Fixed size block filled in place, it is never resized
+    rows = [None] * block
+    n = 0
+    get = row_q.get
+    while True:
+        row = get()
+        if row is None:
+            break
+        rows[n] = row
+        n += 1
+        if n == block:
+            print_rows(write, rows, is_acc, emit_block)
+            if pbar is not None:
+                pbar.update(n)
+            n = 0
+        elif flush_idle and row_q.empty():
+            print_rows(write, rows[:n], is_acc, emit_block)
+            if pbar is not None:
+                pbar.update(n)
+            n = 0
+    print_rows(write, rows[:n], is_acc, emit_block)
+    if pbar is not None:
+        pbar.update(n)
+
+
+def run_row_writer(errors, *args):
+    """
+    Runs row_writer(), an exception ending the writer thread (e.g. disk
+    full) is kept in errors for stop_writer() to re-raise
+    """
+    try:
+        row_writer(*args)
+    except BaseException as e:
+        errors.append(e)
+
+
+def start_writer(file, pbar, is_acc, noscale, tm_posix, tempc, no_count):
+    """
+    Starts the row writer thread, returns its queue and thread
+    """
+    row_q = queue.SimpleQueue()
+    if file is sys.stdout:
+        # Console output is written once the receive loop is idle, or
+        # per CONSOLE_BLOCK rows while it keeps up with a fast stream,
+        # a line buffered terminal then sees one write per block
+        block = CONSOLE_BLOCK
+        flush_idle = True
+        write = file.write
+        newline = "\n"
     else:
-        print(",", can_, end="", file=file)
-        print(",", time_stamp_, end="", file=file)
-    if args.tempc:
-        print(", {:+05.06f}".format(tempc_),end="", file=file)
-    if not args.no_count:
-        print(", {:05}".format(sample_count_), end="", file=file)
-    print(file=file)
+        # CSV file is binary, rows use the platform line end as
+        # text mode did
+        block = WRITE_BLOCK
+        flush_idle = False
+        write = functools.partial(write_bytes, file)
+        newline = os.linesep
+    # Output flags are fixed for the session, select the formatter once
+    emit_block = compile_emit_block(is_acc, noscale, tm_posix, tempc,
+                                    no_count, newline)
+    errors = []
+    writer = threading.Thread(
+        target=run_row_writer,
+        args=(errors, row_q, write, pbar, block, is_acc, emit_block,
+              flush_idle),
+        daemon=True,
+    )
+    writer.errors = errors
+    writer.start()
+    return row_q, writer
+
+
+def stop_writer(row_q, writer):
+    """
+    Sends the sentinel to the row writer thread and waits for it to finish
+
+    :raises Exception:
+        The error that ended the writer thread, if any
+    """
+    if writer is not None:
+        row_q.put(None)
+        writer.join()
+        if writer.errors:
+            raise writer.errors[0]
 
 # Sub function for configuration
 def sync_send(bus_, file,args):
@@ -887,9 +1104,27 @@ def sync_send(bus_, file,args):
     sync_msg = can.Message(arbitration_id=cob_id["SYNC"],
                            data=[], is_extended_id=False)
     task = bus_.send_periodic(sync_msg, 1 / args.sync_hz)
+    raise_sync_priority(task)
     return task
 
 
+def raise_sync_priority(task):
+    """
+    Raises the SYNC sender thread to time critical priority on Windows
+    NOTE: SocketCAN send_periodic() runs in the kernel (BCM) and has no
+          Python thread, other platforms are left as is
+    """
+    thread = getattr(task, "thread", None)
+    if thread is None or not sys.platform.startswith("win"):
+        return
+    kernel32 = ctypes.windll.kernel32
+    handle = kernel32.OpenThread(THREAD_SET_INFORMATION, False,
+                                 thread.native_id)
+    if handle:
+        kernel32.SetThreadPriority(handle, THREAD_PRIORITY_TIME_CRITICAL)
+        kernel32.CloseHandle(handle)
+
+
 def time_send(bus_):
     """
     Sends a TIME message based on host time
@@ -898,10 +1133,7 @@ def time_send(bus_):
     day_ = canopen_datetime.days
     ms_ = (canopen_datetime.seconds * 1000
            + canopen_datetime.microseconds / 1000) * 16
-    time_of_day = struct.pack("<HI", day_, int(ms_))
-    time_msg = can.Message(
-        arbitration_id=cob_id["TIME"], data=time_of_day, is_extended_id=False
-    )
+    PACK_TIME_INTO(time_msg.data, 0, day_, int(ms_))
     bus_.send(time_msg)
 
 
@@ -915,121 +1147,133 @@ def nmt_send(bus_, cmd,node=0x00):
     )
     bus_.send(nmt_msg)
     
-def sdo_write(bus_, byte,index,subindex,dat):
+def wait_until(bus_, pred, timeout):
+    """
+    Receives messages until pred(msg) is true or timeout seconds pass,
+    messages not matching pred are discarded
+
+    :returns:
+        The matching message, None on timeout
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        msg = bus_.recv(timeout=remaining)
+        if msg is not None and pred(msg):
+            return msg
+
+@contextlib.contextmanager
+def rsdo_only(bus_):
+    """
+    Passes only RSDO messages through the bus filter inside the block,
+    the prior filters are restored on exit
+    """
+    prior_filters = bus_.filters
+    bus_.set_filters([rsdo_filter])
+    try:
+        yield bus_
+    finally:
+        bus_.set_filters(prior_filters)
+
+
+def sdo_transfer(bus_, can_data, byte=4, signed=False):
+    """
+    Sends a TSDO request and waits for the RSDO response
+    Only RSDO messages are passed by the bus filter during the transfer,
+    so TPDO & HB traffic is not decoded while waiting
+    The response data is decoded as a byte-wide (1, 2 or 4) integer
+    can_data is None when the payload is already packed into tsdo_msg
+
+    :raises can.CanError:
+        If no RSDO response is received within SDO_TIMEOUT seconds
+    :returns:
+        Data field of the RSDO response
+    """
+    tsdo_msg.arbitration_id = cob_id["TSDO"]
+    if can_data is not None:
+        tsdo_msg.data[:] = can_data
+    rsdo_id = cob_id["RSDO"]
+    with rsdo_only(bus_):
+        bus_.send(tsdo_msg)
+        while True:
+            msg = bus_.recv(timeout=SDO_TIMEOUT)
+            if msg is None:
+                raise can.CanError("No SDO response, RSDO CAN_ID: {:x}".format(rsdo_id))
+            if (msg.arbitration_id) == rsdo_id:
+                d = msg.data
+                rcmd = d[0]
+                rindex = d[1] | (d[2] << 8)
+                rsubindex = d[3]
+                rdat = int.from_bytes(d[4:4 + byte], "little", signed=signed)
+                print("RSDO detected CAN_ID: {:x},{:x},{:x},{:x}".format(rcmd,rindex,rsubindex,rdat))
+                return rdat
+
+def sdo_download_data(byte,index,subindex,dat):
+    """
+    Returns the 8-byte TSDO expedited download payload
+    """
     if byte == 1:
         cmd = 0x2f
         STRCT=STRUCT_SDO1B
-        can_data =struct.pack(STRCT, cmd, index, subindex,dat,0,0,0)
+        can_data =STRCT.pack(cmd, index, subindex,dat,0,0,0)
     elif byte == 2:
         cmd = 0x2b
         STRCT=STRUCT_SDO2H
-        can_data =struct.pack(STRCT, cmd, index, subindex,dat,0,0)
+        can_data =STRCT.pack(cmd, index, subindex,dat,0,0)
     elif byte == 4:
         cmd = 0x23
         STRCT=STRUCT_SDO4I
-        can_data =struct.pack(STRCT, cmd, index, subindex,dat)
+        can_data =STRCT.pack(cmd, index, subindex,dat)
     else:
         cmd =0x23
         STRCT=STRUCT_SDO4I
-        can_data =struct.pack(STRCT, cmd, index, subindex,dat)
-    
-    sdo_msg = can.Message(
-        arbitration_id=cob_id["TSDO"], data=can_data, is_extended_id=False
-    )
-    bus_.send(sdo_msg)
-    
-    time.sleep(0.001)
+        can_data =STRCT.pack(cmd, index, subindex,dat)
+    return can_data
+
+# Precomputed payloads for fixed configuration writes
+# TPDO1 transmission type: 0xFE timer event, 0x01 every SYNC
+SDO_TPDO1_EVENT = sdo_download_data(1,0x1800,0x02,0xFE)
+SDO_TPDO1_SYNC = sdo_download_data(1,0x1800,0x02,0x01)
+# Filter selection payload per --filter name
+SDO_FILTER_SEL = {k: sdo_download_data(1,0x61A1,0x01,v) for k, v in FILTER_SEL.items()}
+SDO_FILTER_SEL2 = {k: sdo_download_data(1,0x61A1,0x01,v) for k, v in FILTER_SEL2.items()}
+SDO_FILTER_SEL_ACC = {k: sdo_download_data(1,0x61A1,0x01,v) for k, v in FILTER_SEL_ACC.items()}
 
-    STRCT=STRUCT_SDO4I
-    for msg in bus_:
-        if (msg.arbitration_id) == cob_id["RSDO"]:
-                rcmd,rindex,rsubindex,rdat = struct.unpack(STRCT, msg.data)
-                print("RSDO detected CAN_ID: {:x},{:x},{:x},{:x}".format(rcmd,rindex,rsubindex,rdat))
-                break
-
-    return rdat
+def sdo_write(bus_, byte,index,subindex,dat):
+    return sdo_transfer(bus_, sdo_download_data(byte,index,subindex,dat))
     
 
-def sdo_read(bus_,byte,index,subindex):
+def sdo_read(bus_,byte,index,subindex,signed=False):
     cmd =0x40
     STRCT=STRUCT_SDO4I
-    can_data =struct.pack(STRCT, cmd, index, subindex,0)
-    sdo_msg = can.Message(
-        arbitration_id=cob_id["TSDO"], data=can_data, is_extended_id=False
-    )
-    bus_.send(sdo_msg)
-    time.sleep(0.001)
-    if byte == 1:
-        STRCT=STRUCT_SDO4I
-    elif byte == 2:
-        STRCT=STRUCT_SDO4I
-    elif byte == 4:
-        STRCT=STRUCT_SDO4I
-    else:
-        STRCT=STRUCT_SDO4I
-    for msg in bus_:
-        if (msg.arbitration_id) == cob_id["RSDO"]:
-                rcmd,rindex,rsubindex,rdat = struct.unpack(STRCT, msg.data)
-                print("RSDO detected CAN_ID: {:x},{:x},{:x},{:x}".format(rcmd,rindex,rsubindex,rdat))
-                break
-
-    return rdat
+    STRCT.pack_into(tsdo_msg.data, 0, cmd, index, subindex,0)
+    if byte not in (1, 2, 4):
+        byte = 4
+    return sdo_transfer(bus_, None, byte, signed)
 
 def get_model(bus_):
-    prodcode = []
-    result = []
-    tmp=(sdo_read(bus_,4,0x1008,0))
-    result.append((tmp) & 0xff)
-    result.append((tmp >> 8) & 0xff)
-    result.append((tmp >> 16) & 0xff)
-    result.append((tmp >> 24) & 0xff)
-    tmp=(sdo_read(bus_,4,0x1009,0))
-    result.append((tmp) & 0xff)
-    result.append((tmp >> 8) & 0xff)
-    result.append((tmp >> 16) & 0xff)
-    result.append((tmp >> 24) & 0xff)
-    for item in result:
-        prodcode.append(item & 0xFF)
-    array=''.join(chr(i) for i in prodcode)
-
-    return array
+    # Product code, 8 characters in 0x1008 & 0x1009
+    buf = STRUCT_ID2W.pack(sdo_read(bus_,4,0x1008,0),
+                           sdo_read(bus_,4,0x1009,0))
+    return buf.decode("latin-1")
 
 def get_ver(bus_):
-    prodcode = []
-    result = []
-    tmp=(sdo_read(bus_,4,0x100a,0))
-    result.append((tmp) & 0xff)
-    result.append((tmp >> 8) & 0xff)
-    result.append((tmp >> 16) & 0xff)
-    result.append((tmp >> 24) & 0xff)
-    for item in result:
-        prodcode.append(item & 0xFF)
-    array=''.join(chr(i) for i in prodcode)
-
-    return array
+    # Software version, 4 characters in 0x100a
+    buf = STRUCT_ID1W.pack(sdo_read(bus_,4,0x100a,0))
+    return buf.decode("latin-1")
 
 def get_SN(bus_):
-    prodcode = []
-    result = []
-    tmp=(sdo_write(bus_,1,0x3000,0x7e,0x01))
-    tmp=(sdo_read(bus_,2,0x3000,0x74))
-    result.append((tmp) & 0xff)
-    result.append((tmp >> 8) & 0xff)
-    tmp=(sdo_read(bus_,2,0x3000,0x76))
-    result.append((tmp) & 0xff)
-    result.append((tmp >> 8) & 0xff)
-    tmp=(sdo_read(bus_,2,0x3000,0x78))
-    result.append((tmp) & 0xff)
-    result.append((tmp >> 8) & 0xff)
-    tmp=(sdo_read(bus_,2,0x3000,0x7a))
-    result.append((tmp) & 0xff)
-    result.append((tmp >> 8) & 0xff)
-    tmp=(sdo_write(bus_,1,0x3000,0x7e,0x00))
-    for item in result:
-        prodcode.append(item & 0xFF)
-    array=''.join(chr(i) for i in prodcode)
-
-    return array
+    # Serial number, 8 characters in 0x3000 sub 0x74~0x7a
+    # readable while 0x3000 sub 0x7e is set
+    sdo_write(bus_,1,0x3000,0x7e,0x01)
+    buf = STRUCT_ID4H.pack(sdo_read(bus_,2,0x3000,0x74),
+                           sdo_read(bus_,2,0x3000,0x76),
+                           sdo_read(bus_,2,0x3000,0x78),
+                           sdo_read(bus_,2,0x3000,0x7a))
+    sdo_write(bus_,1,0x3000,0x7e,0x00)
+    return buf.decode("latin-1")
 
 def sdo_seq(bus_,byte,index,subindex,dat):
     pass
@@ -1046,7 +1290,7 @@ def save_param(bus_):
    
 def ev_mode(bus_,intvl,model):
     dat =  str(int(intvl))
-    sdo_write(bus_,1,0x1800,0x02,0xFE)
+    sdo_transfer(bus_,SDO_TPDO1_EVENT)
     if  model[:7] in ('A552AC1'):
         param=DRATE_SEL2[dat]
         sdo_write(bus_,4,0x2001,0,param)
@@ -1056,21 +1300,22 @@ def ev_mode(bus_,intvl,model):
     
 def sync_mode(bus_,intvl):
     dat =  intvl
-    sdo_write(bus_,1,0x1800,0x02,0x01)
+    sdo_transfer(bus_,SDO_TPDO1_SYNC)
     sdo_write(bus_,4,0x2001,0,dat)
     
 def apply_param(bus_,dat):
+    # Returns once the SDO write is acknowledged, the caller waits
+    # APPLY_PARAM_DELAY for the parameters to take effect
     sdo_write(bus_,1,0x2005,0x00,dat)
-    time.sleep(1)
 
 def filter_set(bus_,dat,model):
     if model[:1] in('A'):
-        param=FILTER_SEL_ACC[dat]
+        can_data=SDO_FILTER_SEL_ACC[dat]
     elif model[:7] in ('G552PC7'):
-        param=FILTER_SEL2[dat] 
+        can_data=SDO_FILTER_SEL2[dat]
     else:
-        param=FILTER_SEL[dat]
-    sdo_write(bus_,1,0x61A1,0x01,param)
+        can_data=SDO_FILTER_SEL[dat]
+    sdo_transfer(bus_,can_data)
     time.sleep(3)
 
 def brate_set(bus_,dat):
@@ -1098,6 +1343,25 @@ def main(arg):
     global TEMPC_25C
     
     time_stamp = dt.datetime.now().strftime("%Y%m%d-%H%M%S")
+    # Row writer thread, started before the receive loop
+    row_q = None
+    writer = None
+    # Number of received messages with unrecognized CAN_ID
+    unk = 0
+    # CSV file, opened once the model is known
+    f = None
+    bus = None
+    # Sample & HB state updated by the handlers, created before the
+    # try so the exit summary can read it on any early exit
+    st = {
+        "can_timestamp": 0,
+        "hb_captured": 0,
+        # HB count per node number
+        "hb_num": [0] * (args.node_num + 1),
+        # IMU samples being reassembled by sample counter
+        "slots": {},
+        "slots_dropped": 0,
+    }
     
     print("Start: \t\t" + dt.datetime.now().ctime())
     set_cobid(args.can_id)
@@ -1111,12 +1375,25 @@ def main(arg):
     channel = args.channel
     bitrate = args.bitrate
 
-    # Setup CAN_ID filters to capture TPDO1 & TPDO2 & TPDO4 & HB
-    bus_filters = [op_filter,tpdo1_filter, tpdo2_filter, tpdo3_filter, tpdo4_filter]#,rsdo_filter,tsdo_filter] #,hb_filter]
-
     try:
         bus = can.Bus(interface=interface, channel=channel, bitrate=bitrate)
+        # Setup CAN_ID filters to capture TPDO1~4 & HB
         bus.set_filters(bus_filters)
+        if interface == "socketcan":
+            # Enlarge the kernel receive buffer so bursts of TPDOs are
+            # not dropped while Python is busy
+            # NOTE: The kernel caps SO_RCVBUF at net.core.rmem_max, raise
+            #       it with sysctl if the reported size is smaller
+            bus.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                                  SOCKETCAN_RCVBUF)
+            # Kernel reports double the size to account for overhead
+            rcvbuf = bus.socket.getsockopt(socket.SOL_SOCKET,
+                                           socket.SO_RCVBUF)
+            if rcvbuf < 2 * SOCKETCAN_RCVBUF:
+                print("CAN RX buffer: \t{} bytes, limited by "
+                      "net.core.rmem_max".format(rcvbuf))
+            else:
+                print("CAN RX buffer: \t{} bytes".format(rcvbuf))
 
         # This delay is required for the bus to stabilize and
         # allow the G550PC2 to exit BUS_HEAVY since no other device
@@ -1130,7 +1407,13 @@ def main(arg):
         # Place all nodes to Pre-Op
         print("NMT: Pre-Op")
         nmt_send(bus, nmt["PRE-OP"],args.can_id)
-        time.sleep(1)
+        # Continue as soon as the node's HB reports Pre-Op, otherwise
+        # wait the full second as before
+        hb_node = cob_id["HB"] + args.can_id
+        wait_until(bus, lambda msg: (msg.arbitration_id == hb_node
+                                     and msg.data
+                                     and msg.data[0] == hb_state["PRE-OP"]),
+                   1.0)
 
         # Send a TIME message
         print("TIME: Sent")
@@ -1143,6 +1426,8 @@ def main(arg):
         print('MODEL:\t'+model)
         print('VER:\t'+ver)
         print('S/N:\t'+SNum)
+        # Q-Acc (A...) or IMU, fixed for the session
+        is_acc = model[:1] in ('A')
     
         if not (args.can_id == args.can_id_new) :
             canid_set(bus,args.can_id_new)
@@ -1151,41 +1436,37 @@ def main(arg):
             brate_set(bus,str(args.bitrate_new))
 
         # Generate filename tag based on specified settings for file management
-        if model[:1] in ('A'):
-            if args.sync_hz:
-                fn_end = str(int(args.sync_hz)) + "_" + str(args.filter) + "_32B"
-            else:
-                fn_end = str(int(args.drate))+ "_" + str(args.filter) + "_32B"
-        else:
-            if args.sync_hz:
-                fn_end = str(int(args.sync_hz)) + "_" + str(args.filter) + "_16B"
-            else:
-                fn_end = str(int(args.drate))+ "_" + str(args.filter) + "_16B"
+        fn_end = (
+            f"{int(args.sync_hz or args.drate)}_{args.filter}"
+            f"_{'32B' if is_acc else '16B'}"
+            f"_{'NSC' if args.noscale else 'SCL'}"
+            f"{'_TEMPC' if args.tempc else ''}_ID{args.can_id}"
+        )
 
         if args.noscale:
-            fn_end = fn_end + "_NSC"
             # If noscale option then set scale factor to 1
             GYRO_SF = 1
             ACCL_SF = 1
             TEMPC_SF = 1
         else:
-            fn_end = fn_end + "_SCL"
             # If noscale option then set scale factor from set_SCL()
             set_SCL(model)
-        if (args.tempc):
-            fn_end = fn_end + "_TEMPC"
-        fn_end = fn_end + "_ID" + str(args.can_id)
         if (args.tag is None):
             args.tag = fn_end
         else:
-            args.tag = fn_end + "_" + args.tag
+            args.tag = f"{fn_end}_{args.tag}"
 
-        out_fname = time_stamp + "_" + model+ "_" + args.tag + ".csv"
+        out_fname = f"{time_stamp}_{model}_{args.tag}.csv"
         if args.outfile:
-            f = open(out_fname, "a")
+            # Binary mode with a large write buffer, rows are written
+            # as pre-encoded blocks by the row writer thread
+            f = open(out_fname, "ab", buffering=CSV_BUFSIZE)
+            # Header lines are collected as text, then written once
+            hdr = io.StringIO()
             print("Output File: \t" + out_fname)
         else:
             f = None
+            hdr = None
 
         get_pdo_struct_fmt(model)
 
@@ -1194,24 +1475,15 @@ def main(arg):
         # for output formatting
         tpdo_flg = 0
         tpdo_captured = 0
-        hb_captured = 0
-        sample_count1 = 0
-        sample_count2 = 0
-        sample_count3 = 0
-        sample_count4 = 0
-        gx = 0
-        gy = 0
-        gz = 0
-        ax = 0
-        ay = 0
-        az = 0
-        time_days = 0
-        time_millisecs = 0
-        tempc = 0
         index = 0
-        hb_msg = 0
-        hb1_num = 0
-        hb2_num = 0
+        # Latest raw TPDO payloads, zero filled for a disabled TPDO,
+        # sized for the model's TPDO layout
+        st.update(
+            tpdo1=bytes(STRUCT_TPDO1.size),
+            tpdo2=bytes(STRUCT_TPDO2.size),
+            tpdo3=bytes(STRUCT_TPDO3.size),
+            tpdo4=bytes(STRUCT_TPDO4.size),
+        )
 
         if args.sync_hz:
             sync_mode(bus,1)
@@ -1222,7 +1494,7 @@ def main(arg):
             filter_set(bus,args.filter,model)
 
         if args.tempc:
-            if model[:1] in ('A'):
+            if is_acc:
                 rd4=sdo_read(bus,4,0x1803,1)
                 rd4=rd4 & ~0x80000000
                 sdo_write(bus,4,0x1803,1,rd4)
@@ -1244,7 +1516,9 @@ def main(arg):
         if(not (rd4 & 0x80000000)):
             tpdo_flg |= 0x08
         apply_param(bus,0x01)
-        time.sleep(2)
+        # No TPDO or status to poll for, TPDOs are only sent after
+        # NMT start
+        time.sleep(APPLY_PARAM_DELAY)
         if args.svcfg:
             save_param(bus)
             time.sleep(3)
@@ -1256,115 +1530,132 @@ def main(arg):
         if args.sync_hz:
             # Start sending SYNCs
             print("Send a SYNC message @ {} Hz".format(args.sync_hz))
-            sync_send(bus, f,args)
+            sync_send(bus, hdr,args)
         else:
-            print("Timer event mode @ {} Hz".format(args.drate), file=f)
+            print("Timer event mode @ {} Hz".format(args.drate), file=hdr)
 
-        if model[:1] in ('A'):
-            print_header_acc(f,args,model,ver,SNum)
-        else:
-            print_header(f,args,model,ver,SNum)
+        print_header(hdr,args,model,ver,SNum)
+        if f is not None:
+            write_bytes(f, hdr.getvalue().replace("\n", os.linesep))
 
         if args.outfile:
-            pbar = tqdm.tqdm(total=args.max_sample, unit="samples")
+            # Updated once per WRITE_BLOCK rows by the row writer thread,
+            # plain ASCII bar on the Windows console
+            pbar = tqdm.tqdm(total=args.max_sample, unit="samples",
+                             mininterval=0.5,
+                             ascii=sys.platform.startswith("win"))
+        else:
+            pbar = None
+        # Rows go to the CSV file or the console
+        out = f if f is not None else sys.stdout
+        # Cache output flags as locals for the receive loop
+        noscale = args.noscale
+        tm_posix = args.tm_posix
+        tempc_en = args.tempc
+        no_count = args.no_count
+        # Dispatch table from arbitration ID to TPDO/HB handler
+        # Only TPDOs enabled in tpdo_flg are added, a disabled TPDO
+        # (e.g. the temperature TPDO without --tempc) has no entry
+        if is_acc:
+            handlers = (tpdo1_recv, tpdo2_recv, tpdo3_recv, tpdo4_recv)
+        else:
+            handlers = tuple(functools.partial(tpdo_slot_recv, pos=i)
+                             for i in range(4))
+        st["tpdo_flg"] = tpdo_flg
+        dispatch = {
+            cob_id["TPDO{}".format(i + 1)]: handler
+            for i, handler in enumerate(handlers)
+            if tpdo_flg & (1 << i)
+        }
+        dispatch.update(dict.fromkeys(hb_ids, hb_recv))
+        row_q, writer = start_writer(out, pbar, is_acc, noscale, tm_posix,
+                                     tempc_en, no_count)
+        # Bind lookups used per message as locals
+        dispatch_get = dispatch.get
+        row_put = row_q.put
+        max_sample = args.max_sample
+        time_per_nsamples = args.time_per_nsamples
+        recv = bus.recv
+        recv_timeout = RECV_TIMEOUT
+        verbose = args.verbose
+        writer_alive = writer.is_alive
         # iterate over received CAN messages
-        for msg in bus:
-            if (msg.arbitration_id) == hb_id["HB1"]:
-                hb_msg = struct.unpack(STRUCT_HB, msg.data)
-                hb1_num = hb1_num+1
-                print("HB detected CAN_ID: {}".format(hb_msg),", HB1 cyc=: {} times".format(hb1_num))
-                hb_captured |= 1
-            elif msg.arbitration_id == cob_id["TPDO1"]:
-                # NOTE: python-can can.Message.timestamp is POSIX UTC Time!
-                can_timestamp = msg.timestamp
-                if model[:1] in ('A'):
-                    ax,ay = struct.unpack(STRUCT_TPDO1,msg.data)
-                else:
-                    sample_count1, gx, gy, gz = struct.unpack(STRUCT_TPDO1,msg.data)
-                tpdo_captured |= 1
-            elif msg.arbitration_id == cob_id["TPDO2"]:
-                if model[:1] in ('A'):
-                    az,sample_count1 = struct.unpack(STRUCT_TPDO2,msg.data)
-                else:
-                    sample_count2, ax, ay, az = struct.unpack(STRUCT_TPDO2,msg.data)
-                tpdo_captured |= 2
-            elif msg.arbitration_id == cob_id["TPDO3"]:
-                if model[:1] in ('A'):
-                    time_days, time_millisecs = struct.unpack(STRUCT_TPDO3, msg.data)
-                    time_millisecs /= 16
-                else:
-                    sample_count3,angx, angy, angz = struct.unpack(STRUCT_TPDO3, msg.data)
-                tpdo_captured |= 4
-            elif msg.arbitration_id == cob_id["TPDO4"]:
-                if model[:1] in ('A'):
-                    tempc, = struct.unpack(STRUCT_TPDO4, msg.data)
-                else:
-                    sample_count4, time_millisecs, time_days = struct.unpack(STRUCT_TPDO4, msg.data)
-                    time_millisecs /= 16
-                tpdo_captured |= 8
+        # NOTE: python-can returns one frame per recv() call, frames
+        #       queued in the driver are consumed back to back and
+        #       decoding is batched by the row writer thread
+        while True:
+            msg = recv(recv_timeout)
+            if msg is None:
+                continue
+            handler = dispatch_get(msg.arbitration_id)
+            if handler:
+                tpdo_captured |= handler(msg, st)
             else:
-                print("Unrecognized CAN_ID: {}".format(msg))
+                # Count unrecognized messages, print each only with -v
+                unk += 1
+                if verbose:
+                    print("Unrecognized CAN_ID: {}".format(msg))
+                elif unk & 0xFF == 0:
+                    sys.stderr.write("{} unrecognized CAN_ID messages\n".format(unk))
             # Only print row if we have complete set of samples
             if tpdo_captured == tpdo_flg:
-                if model[:1] in ('A'):
-                    print_row_acc(
-                        index,
-                        ax * ACCL_SF,
-                        ay * ACCL_SF,
-                        az * ACCL_SF,
-                        sample_count1,
-                        can_timestamp,
-                        time_days,
-                        time_millisecs,
-                        (tempc * TEMPC_SF) + TEMPC_25C,
-                        f,
-                        args
-                    )
-                    
-                else:
-                    print_row(
-                        index,
-                        gx * GYRO_SF,
-                        gy * GYRO_SF,
-                        gz * GYRO_SF,
-                        ax * ACCL_SF,
-                        ay * ACCL_SF,
-                        az * ACCL_SF,
-                        sample_count1,
-                        can_timestamp,
-                        time_days,
-                        time_millisecs,
-                        (angx+TEMPC_25C) * TEMPC_SF+25,
-                        f,
-                        args
-                    )
+                # Queue the raw payloads, decoding, scaling & formatting
+                # is done by the row writer thread
+                row_put((
+                    index,
+                    st["can_timestamp"],
+                    st["tpdo1"],
+                    st["tpdo2"],
+                    st["tpdo3"],
+                    st["tpdo4"],
+                ))
                 tpdo_captured = 0
-                if args.time_per_nsamples:
-                    if index % args.time_per_nsamples == 0:
-                        pass
-                if args.outfile and (index % 50 == 0):
-                    pbar.update(50)
+                # TIME message from host clock every N samples (-t)
+                if time_per_nsamples and index % time_per_nsamples == 0:
+                    time_send(bus)
                 index += 1
-            if index == args.max_sample:
+                # Stop if the writer thread ended on an error, it is
+                # re-raised by stop_writer()
+                if not index & 0x3FF and not writer_alive():
+                    break
+            if index == max_sample:
                 break
             
             
             # Place all nodes to ResetNode
-            if hb_captured == 0x01:
-                hb_captured = 0
+            if st["hb_captured"] == 0x01:
+                st["hb_captured"] = 0
             
-    except (can.interfaces.pcan.pcan.PcanError) as e:
-        print("PcanError. Check CAN hardware connection. {}".format(e))
-        if args.outfile:
-            f.close()
-        sys.exit()
+    # NOTE: PcanError is a can.CanError, can.interfaces.pcan is only
+    #       loaded with a PCAN bus so it cannot be named here
     except (can.CanError) as e:
         print("CanError. Check CAN hardware connection. {}".format(e))
-        if args.outfile:
-            f.close()
+        if bus is not None:
+            # Best effort, the bus itself may be the cause of the error
+            with contextlib.suppress(can.CanError):
+                print("NMT: Pre-Op")
+                nmt_send(bus, nmt["PRE-OP"],args.can_id)
+                bus.stop_all_periodic_tasks()
+            bus.shutdown()
         sys.exit()
     except KeyboardInterrupt:
         print("CTRL-C exit")
+    finally:
+        # Output the remaining queued rows & close the CSV on every exit
+        # path, the writer is a daemon thread and its rows are lost
+        # otherwise
+        try:
+            stop_writer(row_q, writer)
+        finally:
+            if f is not None:
+                f.close()
+    if unk:
+        print("Unrecognized CAN_ID: {} messages".format(unk))
+    if st["slots_dropped"]:
+        print("Incomplete samples dropped: {}".format(st["slots_dropped"]))
+    for node, num in enumerate(st["hb_num"]):
+        if num:
+            print("HB{} detected: {} times".format(node, num))
     # Place all nodes to Pre-Op
     print("NMT: Pre-Op")
     nmt_send(bus, nmt["PRE-OP"],args.can_id)
@@ -1376,7 +1667,6 @@ def main(arg):
     time.sleep(0.5)
     if args.outfile:
         pbar.close()
-        f.close()
         
 
 if __name__ == "__main__":